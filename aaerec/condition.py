@@ -1,15 +1,22 @@
 import torch
 import torch.nn as nn
-from docutils.nodes import inline
 
 from torch import optim
+from torch.ao.nn.quantized import EmbeddingBag as QuantizedEmbeddingBag
+from torch.ao.quantization import float_qparams_weight_only_qconfig
 
 from abc import ABC, abstractmethod
-from collections import OrderedDict, Counter
+import copy
+import functools
+import numbers
+import warnings
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import itertools as it
-import torch
 import scipy.sparse as sp
 import numpy as np
+import pandas as pd
 
 from sklearn.feature_extraction.text import CountVectorizer
 
@@ -28,6 +35,148 @@ and (optional) to update its parameters wrt (global) ae loss.
 """
 
 
+# Thread pool shared by all condition lists, created on first use
+_POOL = None
+
+
+def _thread_pool():
+    """ Returns the thread pool to transform and encode conditions in """
+    global _POOL
+    if _POOL is None:
+        _POOL = ThreadPoolExecutor()
+    return _POOL
+
+
+def _adam_impl_options(device):
+    """ Returns keyword arguments for `optim.Adam` that select the fastest
+    available implementation for parameters on `device`:
+    a single fused kernel on CUDA, multi-tensor (foreach) updates otherwise.
+    On CUDA, the optimizer state is kept on the device (capturable),
+    such that optimizer steps can be captured in CUDA graphs.
+    """
+    if torch.device(device).type == 'cuda':
+        return {'fused': True, 'capturable': True}
+    return {'foreach': True}
+
+
+def _carry_over_state(source, target):
+    """ Copies the state of parameters shared by the optimizers `source` and
+    `target`, if both use the same implementation """
+    if source is None or source.defaults.get('fused') \
+            != target.defaults.get('fused'):
+        return
+    for group in target.param_groups:
+        for p in group['params']:
+            if p in source.state:
+                target.state[p] = source.state[p]
+
+
+def _counting_fits(fit):
+    """ Wraps a fit method of a condition, such that it counts the fits
+    in `_fit_count` """
+    @functools.wraps(fit)
+    def counting_fit(self, *args, **kwargs):
+        result = fit(self, *args, **kwargs)
+        self._fit_count += 1
+        return result
+    return counting_fit
+
+
+def _fill_concat(x, conditions, condition_inputs, out=None):
+    """ Concatenates `x` and all encoded conditions along dim 1
+    by writing each of them into its slice of one preallocated output.
+    If `out` is not given, it is allocated. """
+    if out is None:
+        total = x.size(1) + sum(c.size_increment() for c in conditions)
+        out = torch.empty(x.size(0), total, device=x.device, dtype=x.dtype)
+    out[:, :x.size(1)].copy_(x, non_blocking=True)
+    end = x.size(1)
+    for condition, condition_input in zip(conditions, condition_inputs):
+        start, end = end, end + condition.size_increment()
+        out[:, start:end].copy_(condition.encode(condition_input),
+                                non_blocking=True)
+    return out
+
+
+def _object_index(items):
+    """ Returns a `pd.Index` of `items` as they are, without coercing their
+    types and without turning tuples into a `pd.MultiIndex` """
+    return pd.Index(items, dtype=object, tupleize_cols=False)
+
+
+def _csr_hstack(a, b):
+    """ Horizontally stacks two sparse matrices with equal number of rows
+    into CSR format, without the overhead of `scipy.sparse.hstack`.
+    Row i of the result holds the entries of row i of `a`, then those of
+    row i of `b` with column indices shifted by `a.shape[1]`. """
+    a, b = sp.csr_matrix(a), sp.csr_matrix(b)
+    assert a.shape[0] == b.shape[0], "Number of rows must match"
+    n_cols = a.shape[1] + b.shape[1]
+    nnz = a.nnz + b.nnz
+    index_dtype = np.int32 if max(nnz, n_cols) <= np.iinfo(np.int32).max\
+        else np.int64
+    indptr = a.indptr.astype(index_dtype) + b.indptr.astype(index_dtype)
+    # Target position of each entry: its offset within its row of `a` (`b`)
+    # plus the start of the row in the result, plus the entries of `a`
+    row_nnz_a, row_nnz_b = np.diff(a.indptr), np.diff(b.indptr)
+    target_a = np.arange(a.nnz, dtype=index_dtype)\
+        + np.repeat(b.indptr[:-1], row_nnz_a)
+    target_b = np.arange(b.nnz, dtype=index_dtype)\
+        + np.repeat(a.indptr[1:], row_nnz_b)
+    indices = np.empty(nnz, dtype=index_dtype)
+    indices[target_a] = a.indices
+    indices[target_b] = b.indices + a.shape[1]
+    data = np.empty(nnz, dtype=np.result_type(a.dtype, b.dtype))
+    data[target_a] = a.data
+    data[target_b] = b.data
+    stacked = sp.csr_matrix((data, indices, indptr),
+                            shape=(a.shape[0], n_cols))
+    # Sorted rows remain sorted, as the columns of `b` come after those of `a`
+    stacked.has_sorted_indices = a.has_sorted_indices and b.has_sorted_indices
+    return stacked
+
+
+def _impose_film(x, scale, bias):
+    """ Computes `x * scale + bias`, in a single kernel for torch tensors """
+    if isinstance(x, torch.Tensor):
+        return torch.addcmul(bias, x, scale)
+    return x * scale + bias
+
+
+def _inplace_equivalent(x, y):
+    """ Whether an in-place binary operation on tensor `x` with `y` yields the
+    same result as the out-of-place one, i.e. neither broadcasting nor type
+    promotion changes the shape or dtype of `x` """
+    return isinstance(x, torch.Tensor) and isinstance(y, torch.Tensor)\
+        and torch.result_type(x, y) == x.dtype\
+        and torch.broadcast_shapes(x.shape, y.shape) == x.shape
+
+
+def _add_(x, y):
+    """ Computes `x + y`, in-place on `x` where equivalent """
+    if _inplace_equivalent(x, y):
+        return x.add_(y)
+    return x + y
+
+
+def _mul_(x, y):
+    """ Computes `x * y`, in-place on `x` where equivalent """
+    if _inplace_equivalent(x, y):
+        return x.mul_(y)
+    return x * y
+
+
+def _nested_to_bags(nested):
+    """ Flattens a nested tensor of variable-length index bags
+    into the (indices, offsets) format of `nn.EmbeddingBag` """
+    if nested.layout == torch.jagged:
+        return nested.values(), nested.offsets()[:-1]
+    bags = nested.unbind()
+    bag_sizes = torch.tensor([len(bag) for bag in bags], device=nested.device)
+    offsets = torch.cumsum(bag_sizes, 0) - bag_sizes
+    return torch.cat(bags), offsets
+
+
 def _check_conditions(conditions, condition_data):
     """ Checks condition list and condition data for validity.
     Arguments
@@ -64,28 +213,210 @@ class ConditionList(OrderedDict):
     It subclasses OrderedDict.
     """
 
-    def __init__(self, items):
+    def __init__(self, items, use_compile=False):
+        """
+        Arguments
+        ---------
+        - items: iterable of (name, condition) tuples
+        - use_compile: bool - If given, run `encode_impose` through
+          `torch.compile`, such that the element-wise parts of all conditions
+          are fused into few kernels. Only sensible for conditions operating
+          on torch tensors.
+        """
         super(ConditionList, self).__init__(items)
         assert all(isinstance(v, ConditionBase) for v in self.values())
+        self.optimizer = None
+        # Conditions whose parameters `self.optimizer` updates
+        self._claimed = ()
+        self.use_compile = use_compile
+        self._opt_stream = None
+        self._max_batch_size = None
+        self._concat_buffers = [None, None]
+        self._specialize()
+
+    def __setitem__(self, key, value):
+        super(ConditionList, self).__setitem__(key, value)
+        if hasattr(self, '_forward'):
+            # Conditions changed after construction
+            self._specialize()
+
+    def __delitem__(self, key):
+        super(ConditionList, self).__delitem__(key)
+        self._specialize()
+
+    # Further mutators may bypass __setitem__ and __delitem__ (`update` and
+    # `setdefault` do not)
+
+    def pop(self, *args):
+        value = super(ConditionList, self).pop(*args)
+        self._specialize()
+        return value
+
+    def popitem(self, last=True):
+        item = super(ConditionList, self).popitem(last=last)
+        self._specialize()
+        return item
+
+    def clear(self):
+        super(ConditionList, self).clear()
+        self._specialize()
+
+    def move_to_end(self, key, last=True):
+        super(ConditionList, self).move_to_end(key, last=last)
+        self._specialize()
+
+    def _specialize(self):
+        """ Caches the current conditions, builds the joint optimizer, and
+        generates the forward function for them """
+        # Plain tuple for iteration on the hot path
+        self._cond_tuple = tuple(self.values())
+        self._n = len(self._cond_tuple)
+        self._size_increment = None
+        self.optimizer = self._build_joint_optimizer()
+        forward = self._generate_forward()
+        if self.use_compile:
+            # Compilation itself is deferred to the first call
+            forward = torch.compile(forward, mode="reduce-overhead")
+        self._forward = forward
+
+    def _generate_forward(self):
+        """ Generates straight-line code to encode & impose all conditions in
+        order, such that no iteration, lookups, or dispatch on the conditions
+        is necessary per batch. Scalings directly followed by biasings are
+        imposed at once.
+        """
+        conditions = self._cond_tuple
+        film_pairs = self._find_film_pairs()
+        names = ["c%d" % i for i in range(len(conditions))]
+        namespace = {'_impose_film': _impose_film, '_add_': _add_,
+                     '_mul_': _mul_}
+        lines = ["def _forward(x, {}dim=None):".format(
+            "".join(name + ", " for name in names))]
+        # Whether x is a fresh intermediate result of a stock condition,
+        # which no one else refers to and autograd does not need.
+        # The input x is the caller's.
+        fresh = False
+        i = 0
+        while i < len(conditions):
+            condition = conditions[i]
+            if i in film_pairs:
+                namespace['encode%d' % i] = condition.encode
+                namespace['encode%d' % (i + 1)] = conditions[i + 1].encode
+                lines.append("    x = _impose_film(x, encode{}({}), encode{}({}))"
+                             .format(i, names[i], i + 1, names[i + 1]))
+                fresh = True
+                i += 2
+                continue
+            stock = type(condition).encode_impose is ConditionBase.encode_impose
+            inplace_op = _STOCK_INPLACE_OPS.get(type(condition).impose)
+            if fresh and stock and inplace_op is not None:
+                # Impose in-place on the intermediate result
+                namespace['encode%d' % i] = condition.encode
+                lines.append("    x = {}(x, encode{}({}))"
+                             .format(inplace_op, i, names[i]))
+            else:
+                namespace['encode_impose%d' % i] = condition.encode_impose
+                lines.append("    x = encode_impose{}(x, {}, dim)"
+                             .format(i, names[i]))
+            fresh = stock and type(condition).impose in _STOCK_FRESH_IMPOSES
+            i += 1
+        lines.append("    return x")
+        exec("\n".join(lines), namespace)
+        return namespace['_forward']
+
+    def _find_film_pairs(self):
+        """ Returns the positions of conditional scalings that are directly
+        followed by a conditional biasing. Each such pair is imposed as a
+        single feature-wise affine transformation. Both need to encode and
+        impose as stock conditions do. """
+        conditions = self._cond_tuple
+
+        def stock(condition):
+            return type(condition).encode_impose is ConditionBase.encode_impose
+
+        return frozenset(
+            i for i, (first, second) in enumerate(zip(conditions,
+                                                      conditions[1:]))
+            if isinstance(first, ConditionalScaling)
+            and type(first).impose is ConditionalScaling.impose
+            and stock(first)
+            and isinstance(second, ConditionalBiasing)
+            and type(second).impose is ConditionalBiasing.impose
+            and stock(second)
+        )
+
+    def _build_joint_optimizer(self):
+        """ Builds a single optimizer for the parameters of all dense
+        embedding bag conditions, such that one multi-tensor update replaces one optimizer
+        step per condition. The conditions hand over their own optimizer,
+        unless another condition list optimizes them already.
+        Conditions that left the list get back an optimizer of their own.
+        The optimizer state of parameters is kept.
+        Returns None if no condition has trainable embedding bag parameters.
+        """
+        previous = self.optimizer
+        claimed, params = [], []
+        for condition in self._cond_tuple:
+            if not isinstance(condition, EmbeddingBagCondition) \
+                    or condition.embedding_bag.sparse:
+                # Sparse embedding bags keep their SparseAdam
+                continue
+            if condition._inference_only:
+                # Quantized or cast, no longer trained
+                continue
+            owner = condition._owner
+            if owner is not None and owner is not self:
+                # Optimized by another condition list
+                continue
+            if any(condition is c for c in claimed):
+                continue
+            cond_params = [p for p in condition._params if p.requires_grad]
+            if not cond_params:
+                continue
+            params.extend(cond_params)
+            claimed.append(condition)
+        for condition in self._claimed:
+            if not any(condition is c for c in claimed):
+                condition._take_back_optimizer(previous)
+        self._claimed = tuple(claimed)
+        if not params:
+            return None
+        if all(p.device.type == 'cuda' for p in params):
+            options = _adam_impl_options('cuda')
+        else:
+            options = _adam_impl_options('cpu')
+        optimizer = optim.Adam(params, **options)
+        _carry_over_state(previous, optimizer)
+        for condition in claimed:
+            _carry_over_state(condition.optimizer, optimizer)
+            condition.optimizer = None
+            condition._owns_optimizer = False
+            condition._owner = self
+        return optimizer
 
     def fit(self, raw_inputs):
         """ Fits all conditions to data """
         assert len(raw_inputs) == len(self)
-        for cond, cond_inp in zip(self.values(), raw_inputs):
+        for cond, cond_inp in zip(self._cond_tuple, raw_inputs):
             cond.fit(cond_inp)
+        # Fitting may change the size of conditions
+        self._freeze_size_increment()
         return self
 
     def transform(self, raw_inputs):
         """ Transforms `raw_inputs` with all conditions """
         assert len(raw_inputs) == len(self)
-        return [c.transform(inp) for c, inp in zip(self.values(), raw_inputs)]
+        return self._map('transform', raw_inputs)
 
     def fit_transform(self, raw_inputs):
         """ Forwards to fit_transform of all conditions,
         returns list of transformed condition inputs"""
         assert len(raw_inputs) == len(self)
-        return [cond.fit_transform(inp) for cond, inp
-                in zip(self.values(), raw_inputs)]
+        transformed = [cond.fit_transform(inp) for cond, inp
+                       in zip(self._cond_tuple, raw_inputs)]
+        # Fitting may change the size of conditions
+        self._freeze_size_increment()
+        return transformed
 
     def encode_impose(self, x, condition_inputs, dim=None):
         """ Subsequently conduct encode & impose with all conditions
@@ -93,52 +424,245 @@ class ConditionList(OrderedDict):
         : param x: the normal data not the condition ones
         : param condition_inputs: the condition inputs (should be transformed before)
         """
-        assert len(condition_inputs) == len(self)
-        for condition, condition_input in zip(self.values(), condition_inputs):
+        assert len(condition_inputs) == self._n
+        self._wait_for_step()
+        return self._forward(x, *condition_inputs, dim=dim)
+
+    def capture_step(self, x, condition_inputs, loss_fn, optimizers=(),
+                     warmup_steps=3):
+        """ Captures a whole training step (encode & impose, `loss_fn`,
+        backward, and optimizer steps) in a CUDA graph, such that it can be
+        replayed without per-condition Python and launch overhead.
+        All parameters involved need to be updated by capturable optimizers.
+
+        Arguments
+        ---------
+        - x: static CUDA tensor holding the codes
+        - condition_inputs: static CUDA tensors holding the condition inputs
+        - loss_fn: callable mapping the conditioned codes to a scalar loss
+        - optimizers: further optimizers to step, e.g. the decoder's
+        - warmup_steps: int - Number of eager steps before capturing
+
+        Returns
+        -------
+        Tuple (graph, static_loss). To train on a new batch, copy it into
+        `x` and `condition_inputs`, then call `graph.replay()`.
+        `static_loss` holds the loss of the last replay.
+        """
+        def train_step():
+            loss = loss_fn(self.encode_impose(x, condition_inputs))
+            loss.backward()
+            self.step()
+            for optimizer in optimizers:
+                optimizer.step()
+            return loss
+
+        def zero_grad():
+            self.zero_grad()
+            for optimizer in optimizers:
+                optimizer.zero_grad(set_to_none=True)
+
+        # Warm up on a side stream, as required before capturing
+        side_stream = torch.cuda.Stream()
+        side_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(side_stream):
+            for __ in range(warmup_steps):
+                zero_grad()
+                train_step()
+        torch.cuda.current_stream().wait_stream(side_stream)
+
+        # Gradients are allocated from the graph's private memory pool
+        zero_grad()
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            static_loss = train_step()
+        return graph, static_loss
+
+    def encode_impose_fused(self, x, condition_inputs, dim=None):
+        """ Like `encode_impose`, but runs of concatenation-based conditions
+        are written into a single preallocated output instead of growing `x`
+        by one `torch.cat` per condition.
+        : param x: the normal data not the condition ones
+        : param condition_inputs: the condition inputs (should be transformed before)
+        """
+        assert len(condition_inputs) == self._n
+        if not isinstance(x, torch.Tensor) or dim not in (None, 1):
+            return self.encode_impose(x, condition_inputs, dim)
+        self._wait_for_step()
+        pending, pending_inputs = [], []
+        for condition, condition_input in zip(self._cond_tuple, condition_inputs):
+            if isinstance(condition, ConcatenationBasedConditioning) \
+                    and condition.dim == 1:
+                pending.append(condition)
+                pending_inputs.append(condition_input)
+                continue
+            if pending:
+                # Later conditions operate on the concatenated result
+                x = _fill_concat(x, pending, pending_inputs)
+                pending, pending_inputs = [], []
             x = condition.encode_impose(x, condition_input, dim)
+        if pending:
+            total = x.size(1) + sum(c.size_increment() for c in pending)
+            out = self._concat_buffer(x, total)
+            x = _fill_concat(x, pending, pending_inputs, out=out)
+        return x
+
+    def set_max_batch(self, max_batch_size):
+        """ Let `encode_impose_fused` write its output into persistent
+        buffers for up to `max_batch_size` samples instead of allocating
+        a new output per batch. The buffers alternate between calls, so
+        an output stays valid until the next but one call.
+        None disables the buffers.
+        """
+        self._max_batch_size = max_batch_size
+        self._concat_buffers = [None, None]
+        return self
+
+    def _concat_buffer(self, x, total):
+        """ Returns the next output buffer for a batch `x`,
+        None if buffers are disabled or too small """
+        if self._max_batch_size is None or x.size(0) > self._max_batch_size:
+            return None
+        buffer = self._concat_buffers[0]
+        if buffer is None or buffer.size(1) != total \
+                or buffer.device != x.device or buffer.dtype != x.dtype:
+            buffer = torch.empty(self._max_batch_size, total,
+                                 device=x.device, dtype=x.dtype)
+        # Alternate buffers
+        self._concat_buffers = [self._concat_buffers[1], buffer]
+        # Each output gets its own autograd history
+        return buffer[:x.size(0)].detach()
+
+    def encode_impose_nested(self, x, condition_inputs, dim=None):
+        """ Like `encode_impose`, but condition inputs may be nested tensors
+        holding one variable-length bag of indices per sample. These are
+        flattened into (indices, offsets), such that each condition
+        encodes the whole batch with a single embedding bag lookup.
+        Conditions receiving nested inputs need to accept offsets in encode,
+        such as `EmbeddingBagCondition`.
+        """
+        assert len(condition_inputs) == self._n
+        self._wait_for_step()
+        for condition, condition_input in zip(self._cond_tuple, condition_inputs):
+            if isinstance(condition_input, torch.Tensor) \
+                    and condition_input.is_nested:
+                indices, offsets = _nested_to_bags(condition_input)
+                encoded = condition.encode(indices, offsets)
+                x = condition.impose(x, encoded, dim)
+            else:
+                x = condition.encode_impose(x, condition_input, dim)
         return x
 
     def encode(self, condition_inputs):
-        assert len(condition_inputs) == len(self)
-        return [condition.encode(condition_input) for condition, condition_input
-                in zip(self.values(), condition_inputs)]
+        assert len(condition_inputs) == self._n
+        self._wait_for_step()
+        # Sequential, as grad mode, autocast, and the current CUDA stream
+        # are thread-local and would not reach worker threads
+        return [c.encode(inp)
+                for c, inp in zip(self._cond_tuple, condition_inputs)]
+
+    def _map(self, method, inputs):
+        """ Calls `method` of each condition with its input,
+        concurrently in a thread pool when there are several conditions.
+        Conditions are independent and their heavy lifting (scipy)
+        releases the GIL. """
+        if self._n < 2:
+            return [getattr(c, method)(inp)
+                    for c, inp in zip(self._cond_tuple, inputs)]
+        pool = _thread_pool()
+        futures = [pool.submit(getattr(c, method), inp)
+                   for c, inp in zip(self._cond_tuple, inputs)]
+        return [future.result() for future in futures]
 
 
     def zero_grad(self):
         """ Forward the zero_grad call to all conditions in list
         such they can reset their gradients """
-        for condition in self.values():
+        # Gradients may still be in use by the previous step
+        self._wait_for_step()
+        if self.optimizer is not None:
+            self.optimizer.zero_grad(set_to_none=True)
+        for condition in self._cond_tuple:
             condition.zero_grad()
         return self
 
     def step(self):
         """ Forward the step call to all conditions in list,
-        such that these can update their individual parameters"""
-        for condition in self.values():
-            condition.step()
+        such that these can update their individual parameters.
+        On CUDA, the updates are issued on a dedicated stream, such that
+        the host can go on with preparing the next batch.
+        """
+        if not self._use_opt_stream():
+            self._step()
+            return self
+        if self._opt_stream is None:
+            self._opt_stream = torch.cuda.Stream()
+        # Gradients need to be ready
+        self._opt_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._opt_stream):
+            self._step()
         return self
 
+    def _step(self):
+        if self.optimizer is not None:
+            self.optimizer.step()
+        for condition in self._cond_tuple:
+            condition.step()
+
+    def _use_opt_stream(self):
+        """ Whether to run optimizer steps on a dedicated CUDA stream """
+        return self.optimizer is not None\
+            and self.optimizer.param_groups[0]['params'][0].is_cuda\
+            and not torch.cuda.is_current_stream_capturing()
+
+    def _wait_for_step(self):
+        """ Lets the current stream wait for pending parameter updates.
+        No-op while capturing a CUDA graph, which must not wait on work
+        outside the graph, and which synchronizes before capturing. """
+        if self._opt_stream is not None\
+                and not torch.cuda.is_current_stream_capturing():
+            torch.cuda.current_stream().wait_stream(self._opt_stream)
+
     def size_increment(self):
         """ Aggregates sizes from various conditions
         for convenience use in determining decoder properties
         """
-        return sum(v.size_increment() for v in self.values())
+        if self._size_increment is None:
+            self._freeze_size_increment()
+        return self._size_increment
+
+    def _freeze_size_increment(self):
+        """ Queries the size increment of each condition once, checks it,
+        and caches the sum """
+        sizes = [v.size_increment() for v in self._cond_tuple]
+        assert all(isinstance(size, numbers.Integral) and size >= 0
+                   for size in sizes), "Invalid size increments: %s" % sizes
+        self._size_increment = int(sum(sizes))
 
     def train(self):
         # Put all modules into train mode, if they has such a method
-        for condition in self.values():
+        for condition in self._cond_tuple:
             if hasattr(condition, 'train'):
                 condition.train()
 
     def eval(self):
         # Put all modules into train mode, if they have such a method
-        for condition in self.values():
+        for condition in self._cond_tuple:
             if hasattr(condition, 'eval'):
                 condition.eval()
 
 
 class ConditionBase(ABC):
     """ Abstract Base Class for a generic condition """
+    # Number of fits so far, such that caches of transformed data can tell
+    # whether the condition was refit in between
+    _fit_count = 0
+
+    def __init_subclass__(cls, **kwargs):
+        super(ConditionBase, cls).__init_subclass__(**kwargs)
+        for name in ('fit', 'fit_transform'):
+            if name in cls.__dict__:
+                setattr(cls, name, _counting_fits(cls.__dict__[name]))
 
     #####################################################################
     # Condition supplies info how much it will increment the size of data
@@ -148,6 +672,7 @@ class ConditionBase(ABC):
     # Fit adapts the condition object to the data it will receive.
     # Transform may apply some preprocessing that can be conducted globally
     # once.
+    @_counting_fits
     def fit(self, raw_inputs):
         """ Prepares the condition wrt to the whole raw data for the condition
         To be called *once* on the whole (condition)-data.
@@ -159,6 +684,7 @@ class ConditionBase(ABC):
         preprocessing step """
         return raw_inputs
 
+    @_counting_fits
     def fit_transform(self, raw_inputs):
         """ Fit to `raw_inputs`, then transform `raw_inputs`. """
         return self.fit(raw_inputs).transform(raw_inputs)
@@ -267,15 +793,25 @@ class CountCondition(ConditionBase):
         self.cv.fit(raw_inputs)
         return self
 
+    @staticmethod
+    def _binarize(X):
+        """ Stores the binary counts as uint8, which takes an eighth of the
+        memory of the vectorizer's default dtype. Consumers such as `impose`
+        promote the dtype where necessary. Column indices are sorted within
+        rows, which the vectorizer does not guarantee. """
+        X.data = np.ones_like(X.data, dtype=np.uint8)
+        X.sort_indices()
+        return X
+
     def transform(self, raw_inputs):
-        return self.cv.transform(raw_inputs)
+        return self._binarize(self.cv.transform(raw_inputs))
 
     def fit_transform(self, raw_inputs):
-        return self.cv.fit_transform(raw_inputs)
+        return self._binarize(self.cv.fit_transform(raw_inputs))
 
     def impose(self, x, encoded_inputs, dim=None):
         assert dim is None, "dim not supported for scipy.sparse based imposing"
-        return sp.hstack([x, encoded_inputs])
+        return _csr_hstack(x, encoded_inputs)
 
     def size_increment(self):
         return len(self.cv.vocabulary_)
@@ -342,6 +878,70 @@ class ConditionalScaling(ConditionBase):
         return 0
 
 
+# Stock imposing methods that may be replaced by in-place operations on
+# intermediate results within a `ConditionList`
+_STOCK_INPLACE_OPS = {
+    ConditionalBiasing.impose: '_add_',
+    ConditionalScaling.impose: '_mul_',
+}
+
+# Stock imposing methods that return a fresh tensor, which autograd does not
+# save for backward, and which may thus be modified in-place afterwards
+_STOCK_FRESH_IMPOSES = frozenset([
+    ConcatenationBasedConditioning.impose,
+    ConditionalBiasing.impose,
+    ConditionalScaling.impose,
+])
+
+
+class FiLMCondition(ConditionBase):
+    """
+    A *trainable* feature-wise linear modulation (FiLM) condition,
+    i.e. conditional scaling and conditional biasing at once.
+    Scale and bias are linear projections of the condition input.
+    """
+    def __init__(self, in_features, out_features,
+                 use_cuda=torch.cuda.is_available()):
+        """
+        Arguments
+        ---------
+        - in_features: int - Size of the (dense) condition input
+        - out_features: int - Size of the code to modulate
+        """
+        device = torch.device("cuda") if use_cuda else torch.device("cpu")
+        self.linear = nn.Linear(in_features, 2 * out_features).to(device)
+        self.optimizer = optim.Adam(self.linear.parameters(),
+                                    **_adam_impl_options(device))
+
+    def encode(self, inputs):
+        """ Returns (scale, bias) tuple """
+        inputs = torch.as_tensor(inputs, dtype=torch.float32,
+                                 device=self.linear.weight.device)
+        scale, bias = self.linear(inputs).chunk(2, dim=1)
+        return scale, bias
+
+    def impose(self, inputs, encoded_condition, dim=None):
+        """ Applies condition by scaling and biasing in one go """
+        scale, bias = encoded_condition
+        return _impose_film(inputs, scale, bias)
+
+    def size_increment(self):
+        """ FiLM does not increase vector size """
+        return 0
+
+    def zero_grad(self):
+        self.optimizer.zero_grad(set_to_none=True)
+
+    def step(self):
+        self.optimizer.step()
+
+    def train(self):
+        self.linear.train()
+
+    def eval(self):
+        self.linear.eval()
+
+
 class PretrainedWordEmbeddingCondition(ConcatenationBasedConditioning):
     """ A concatenation-based condition using a pre-trained word embedding """
 
@@ -361,7 +961,13 @@ class PretrainedWordEmbeddingCondition(ConcatenationBasedConditioning):
         return self.vect.fit_transform(raw_inputs)
 
     def encode(self, inputs):
-        # GensimEmbeddedVectorizer yields numpy array
+        # GensimEmbeddedVectorizer yields contiguous float32 numpy array
+        if isinstance(inputs, np.ndarray) and inputs.dtype == np.float32:
+            # Share memory instead of copying
+            h = torch.from_numpy(np.ascontiguousarray(inputs))
+            if self.device.type == 'cuda':
+                h = h.to(self.device, non_blocking=True)
+            return h
         return torch.as_tensor(inputs, dtype=torch.float32, device=self.device)
 
     def size_increment(self):
@@ -371,29 +977,220 @@ class PretrainedWordEmbeddingCondition(ConcatenationBasedConditioning):
 
 class EmbeddingBagCondition(ConcatenationBasedConditioning):
     """ A condition with a *trainable* embedding bag.
+    When part of a `ConditionList`, the list takes over the optimization
+    of the embedding bag's (dense) parameters.
     """
+    _owns_optimizer = True
+    # Condition list whose optimizer updates the parameters, if any
+    _owner_ref = None
+    _inference_only = False
+    _quantized = False
+    _copy_stream = None
+
     def __init__(self, num_embeddings, embedding_dim, **kwargs):
+        """
+        Arguments
+        ---------
+        - num_embeddings: int - Vocabulary size
+        - embedding_dim: int - Size of the embedding
+        - kwargs: passed on to `nn.EmbeddingBag`.
+          With `sparse=True`, gradients and the (SparseAdam) update only
+          touch the embeddings looked up in a batch instead of the whole
+          table, which pays off for large vocabularies.
+          Sparse gradients are not supported with `mode='max'`.
+        """
         self.embedding_bag = nn.EmbeddingBag(num_embeddings,
                                              embedding_dim,
                                              **kwargs)
-        self.optimizer = torch.optim.Adam(self.embedding_bag.parameters())
+        if not self.embedding_bag.sparse:
+            # Multi-tensor kernels expect dense, contiguous parameters
+            weight = self.embedding_bag.weight
+            weight.data = weight.data.contiguous()
+        # Materialize parameters once instead of re-creating the generator
+        self._params = list(self.embedding_bag.parameters())
+        if self.embedding_bag.sparse:
+            self.optimizer = optim.SparseAdam(self._params)
+        else:
+            self.optimizer = optim.Adam(self._params,
+                                        **_adam_impl_options(weight.device))
         self.embedding_dim = embedding_dim
 
-    def encode(self, inputs):
-        return self.embedding_bag(inputs)
+    @property
+    def _owner(self):
+        return None if self._owner_ref is None else self._owner_ref()
+
+    @_owner.setter
+    def _owner(self, condition_list):
+        if condition_list is None:
+            self._owner_ref = None
+            return
+
+        def release(ref):
+            # The condition list is discarded
+            if self._owner_ref is ref:
+                self._take_back_optimizer()
+        self._owner_ref = weakref.ref(condition_list, release)
+
+    def _take_back_optimizer(self, joint_optimizer=None):
+        """ Optimizes the parameters on its own again after leaving the
+        condition list, continuing from the state in `joint_optimizer` """
+        self._owner = None
+        if self._inference_only or not self._params:
+            return
+        self.optimizer = optim.Adam(
+            self._params, **_adam_impl_options(self._params[0].device))
+        _carry_over_state(joint_optimizer, self.optimizer)
+        self._owns_optimizer = True
+
+    def prepare_batch(self, indices, offsets=None):
+        """ Moves a batch of condition inputs (and offsets, if given) to the
+        device of the embedding bag. On CUDA, the host to device copy is
+        issued asynchronously from pinned memory on a dedicated copy stream,
+        such that it overlaps with the computation of the previous batch.
+        Returns tuple (indices, offsets).
+        """
+        device = self.embedding_bag.weight.device
+        if device.type != 'cuda':
+            return indices, offsets
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream(device=device)
+        with torch.cuda.stream(self._copy_stream):
+            indices = indices.pin_memory().to(device, non_blocking=True)
+            if offsets is not None:
+                offsets = offsets.pin_memory().to(device, non_blocking=True)
+        return indices, offsets
+
+    def _wait_for_copy(self, *tensors):
+        """ Let the current stream wait for pending copies of `tensors`.
+        No-op while capturing a CUDA graph, see
+        `ConditionList._wait_for_step`. """
+        if self._copy_stream is None\
+                or torch.cuda.is_current_stream_capturing():
+            return
+        current_stream = torch.cuda.current_stream(self._copy_stream.device)
+        current_stream.wait_stream(self._copy_stream)
+        for tensor in tensors:
+            if tensor is not None and tensor.is_cuda:
+                # Memory was allocated on the copy stream
+                tensor.record_stream(current_stream)
+
+    def encode(self, inputs, offsets=None):
+        """ Encodes `inputs`, either a (batch_size, bag_size) index tensor
+        or flat indices with bags starting at `offsets` """
+        self._wait_for_copy(inputs, offsets)
+        h = self.embedding_bag(inputs, offsets)
+        if self._quantized and self._quantized_mode == 'mean':
+            # Quantized lookup sums up the bags
+            if offsets is None:
+                h = h / inputs.size(1)
+            else:
+                end = offsets.new_tensor([inputs.size(0)])
+                bag_sizes = torch.diff(offsets, append=end)
+                h = h / bag_sizes.clamp(min=1).unsqueeze(1).to(h.dtype)
+        return h
+
+    def quantize_for_inference(self):
+        """ Replaces the embedding bag by a copy with int8 (row-wise)
+        quantized weights, which reduces the memory traffic of lookups.
+        The condition can no longer be trained afterwards.
+        Quantized lookups are only available on CPU.
+        """
+        mode = self.embedding_bag.mode
+        assert mode in ['sum', 'mean'], "Only 'sum' and 'mean' can be quantized"
+        assert self.embedding_bag.weight.device.type == 'cpu',\
+            "Quantized embedding bags are only supported on CPU"
+        self.embedding_bag.qconfig = float_qparams_weight_only_qconfig
+        self.embedding_bag = QuantizedEmbeddingBag.from_float(self.embedding_bag)
+        self._params = []
+        self._quantized_mode = mode
+        self._quantized = True
+        self._set_inference_only()
+        return self
+
+    def cast_for_inference(self, dtype=torch.bfloat16):
+        """ Casts the embedding bag to `dtype`, by default bfloat16, which
+        halves the memory traffic of lookups compared to float32.
+        Encoded conditions are of `dtype` then and are promoted on
+        concatenation. The condition can no longer be trained afterwards.
+        """
+        self.embedding_bag.to(dtype)
+        self._set_inference_only()
+        return self
+
+    def _set_inference_only(self):
+        """ Stops training, also by the condition list optimizing it """
+        self._inference_only = True
+        owner = self._owner
+        if owner is not None:
+            # Rebuilds the list's optimizer without the condition
+            owner._specialize()
 
     def zero_grad(self):
-        self.optimizer.zero_grad()
+        if self._owns_optimizer and not self._inference_only:
+            # Dropping the gradients is cheaper than filling them with zeros
+            self.optimizer.zero_grad(set_to_none=True)
 
     def step(self):
         # loss.backward() to be called before by client (such as in ae_step)
         # The condition object can update its own parameters wrt global loss
-        self.optimizer.step()
+        if self._owns_optimizer and not self._inference_only:
+            self.optimizer.step()
 
     def size_increment(self):
         return self.embedding_dim
 
 
+class MultiFieldEmbeddingBagCondition(EmbeddingBagCondition):
+    """ A condition with one *trainable* embedding bag per field,
+    for instance, for several categorical attributes with disjoint
+    vocabularies. All fields share a single embedding bag, such that
+    one lookup replaces one lookup (and concatenation) per field.
+    """
+    def __init__(self, num_embeddings_per_field, embedding_dim, **kwargs):
+        """
+        Arguments
+        ---------
+        - num_embeddings_per_field: list of int - Vocabulary size per field
+        - embedding_dim: int - Size of the embedding per field
+        """
+        super(MultiFieldEmbeddingBagCondition, self).__init__(
+            sum(num_embeddings_per_field), embedding_dim, **kwargs)
+        self.num_embeddings_per_field = list(num_embeddings_per_field)
+        # Index of the first embedding of each field in the shared bag
+        self._bases = [0]
+        for num_embeddings in self.num_embeddings_per_field[:-1]:
+            self._bases.append(self._bases[-1] + num_embeddings)
+
+    def encode(self, inputs):
+        """ Expects a list with one (batch_size, bag_size) index tensor per
+        field, returns the concatenated embeddings of all fields """
+        assert len(inputs) == len(self._bases), "Expecting one input per field"
+        self._wait_for_copy(*inputs)
+        batch_size = inputs[0].size(0)
+        device = self.embedding_bag.weight.device
+        # Lay out bags field by field, one bag per sample
+        indices, offsets, bag_sizes = [], [], []
+        start = 0
+        for base, field_inputs in zip(self._bases, inputs):
+            bag_size = field_inputs.size(1)
+            indices.append((field_inputs + base).view(-1))
+            offsets.append(torch.arange(start, start + batch_size * bag_size,
+                                        bag_size, device=device))
+            bag_sizes.append(bag_size)
+            start += batch_size * bag_size
+        h = self.embedding_bag(torch.cat(indices), torch.cat(offsets))
+        if self._quantized and self._quantized_mode == 'mean':
+            # Quantized lookup sums up the bags
+            h = h / torch.tensor(bag_sizes, dtype=h.dtype, device=h.device)\
+                .repeat_interleave(batch_size).unsqueeze(1)
+        # [n_fields * batch_size, dim] -> [batch_size, n_fields * dim]
+        return h.view(len(self._bases), batch_size, self.embedding_dim)\
+            .transpose(0, 1).reshape(batch_size, -1)
+
+    def size_increment(self):
+        return len(self.num_embeddings_per_field) * self.embedding_dim
+
+
 class CategoricalCondition(ConcatenationBasedConditioning):
     """ A *trainable* condition for categorical attributes.
     """
@@ -402,9 +1199,10 @@ class CategoricalCondition(ConcatenationBasedConditioning):
     def __init__(self, embedding_dim, vocab_size=None,
                  sparse=True,
                  use_cuda=torch.cuda.is_available(),
-                 embedding_on_gpu=False,
+                 embedding_on_gpu=None,
                  lr=1e-3,
                  reduce=None,
+                 dtype=None,
                  **embedding_params):
         """
         Arguments
@@ -414,21 +1212,40 @@ class CategoricalCondition(ConcatenationBasedConditioning):
         - ignore_oov: bool - If given, set oov embedding to zero
         - lr: float - initial learning rate for Adam / SparseAdam
         - sparse: bool - If given, use sparse embedding & optimizer
+        - use_cuda: bool - If given, keep the embedding on GPU
+        - embedding_on_gpu: Deprecated, the embedding is on GPU iff use_cuda
         - reduce: None or str - if given, expect list-of-list like inputs
                   and aggregate according to `reduce` in 'mean', 'sum', 'max'
+        - dtype: torch.dtype - If given, look up embeddings in a copy of
+                 this dtype, e.g. torch.bfloat16 to halve the memory traffic
+                 of lookups. The optimizer updates a float32 master copy,
+                 from which the lookup copy is renewed on each step.
+                 This takes more memory than float32 alone, as both
+                 copies are kept. Encoded conditions are float32
+                 nevertheless.
         """
+        if embedding_on_gpu is not None:
+            warnings.warn("embedding_on_gpu is deprecated, the embedding is"
+                          " put on GPU whenever use_cuda is set",
+                          DeprecationWarning, stacklevel=2)
         # register this module's parameters with the optimizer
         self.vocab_size = vocab_size
         self.embedding_dim = embedding_dim
         self.vocab = None
         self.embedding = None
+        # Lookup copy of the embedding in `dtype`, if given
+        self._embedding_copy = None
         self.optimizer = None
         self.lr = lr
 
+        # Pinned staging memory for host to device copies, allocated lazily
+        self._staging = None
+        self._staging_event = None
+
         # Optimization and memory storay
         self.sparse = sparse
         self.use_cuda = use_cuda
-        self.embedding_on_gpu = embedding_on_gpu
+        self.dtype = dtype
 
         # We take care of vocab handling & padding ourselves
         assert "padding_idx" not in embedding_params, "Padding is fixed with token 0"
@@ -452,18 +1269,48 @@ class CategoricalCondition(ConcatenationBasedConditioning):
             cutoff = int(self.vocab_size)
         print("Using top {:.2f}% authors ({})".format(cutoff / len(flat_items) * 100, cutoff))
 
-        item_cnt = Counter(flat_items).most_common(cutoff)
+        # Hash-based counting keeps items as they are (mixed types, None),
+        # in order of first occurrence
+        item_counts = _object_index(flat_items).value_counts(sort=False,
+                                                             dropna=False)
+        values, counts = item_counts.index, item_counts.to_numpy()
+        if 0 < cutoff < len(values):
+            # Partial sort suffices to find the count of the last top item.
+            # Ties at the cutoff are taken by first occurrence.
+            threshold = -np.partition(-counts, cutoff - 1)[cutoff - 1]
+            above = np.flatnonzero(counts > threshold)
+            ties = np.flatnonzero(counts == threshold)[:cutoff - len(above)]
+            top = np.sort(np.concatenate([above, ties]))
+        else:
+            top = np.arange(min(max(cutoff, 0), len(values)))
+        # Stable, such that ties are ranked by first occurrence
+        top = top[np.argsort(-counts[top], kind='stable')]
+        values = [values[i] for i in top]
         # index 0 is reserved for unk idx
-        self.vocab = {value: idx + 1 for idx, (value, __) in enumerate(item_cnt)}
+        self.vocab = {value: idx + 1 for idx, value in enumerate(values)}
+        # Hash index over the vocabulary, position i holds the item with id i+1
+        self._vocab_index = _object_index(values)
         num_embeddings = len(self.vocab) + 1
-        self.embedding = nn.Embedding(num_embeddings,
-                                      self.embedding_dim,
-                                      padding_idx=self.padding_idx,
-                                      **self.embedding_params,
-                                      sparse=self.sparse)
-        if self.use_cuda and self.embedding_on_gpu:
-            # Put the embedding on GPU only when wanted
+        if self._use_bags():
+            # Lookup and reduction in one kernel, padding is skipped
+            self.embedding = nn.EmbeddingBag(num_embeddings,
+                                             self.embedding_dim,
+                                             mode=self.reduce,
+                                             padding_idx=self.padding_idx,
+                                             **self.embedding_params,
+                                             sparse=self.sparse)
+        else:
+            self.embedding = nn.Embedding(num_embeddings,
+                                          self.embedding_dim,
+                                          padding_idx=self.padding_idx,
+                                          **self.embedding_params,
+                                          sparse=self.sparse)
+        if self.use_cuda:
+            # Look up on GPU, such that only the indices are copied
             self.embedding = self.embedding.cuda()
+        if self.dtype is not None:
+            # The optimizer keeps updating the float32 master
+            self._embedding_copy = copy.deepcopy(self.embedding).to(self.dtype)
         if self.sparse:
             self.optimizer= optim.SparseAdam(self.embedding.parameters(), lr=self.lr)
         else:
@@ -474,34 +1321,126 @@ class CategoricalCondition(ConcatenationBasedConditioning):
         # Actually np.array is not needed,
         # else we would need to do the padding globally
         if self.reduce is None:
-            return [self.vocab.get(x, self.padding_idx) for x in raw_inputs]
+            return self._lookup(raw_inputs)
+        elif len(raw_inputs) == 0:
+            # Splitting would yield one empty list
+            return []
         else:
-            return [[self.vocab.get(x, self.padding_idx) for x in l] for l in raw_inputs]
+            # Look up all items at once, then split into the original lists
+            lengths = np.fromiter(map(len, raw_inputs), dtype=np.int64,
+                                  count=len(raw_inputs))
+            ids = self._lookup(list(it.chain.from_iterable(raw_inputs)))
+            return np.split(ids, np.cumsum(lengths)[:-1])
+
+    def _lookup(self, items):
+        """ Returns int64 array of vocabulary ids of `items`,
+        the padding index for unknown items """
+        # Unknown items are at position -1, and padding_idx is 0
+        ids = self._vocab_index.get_indexer(_object_index(items))
+        return ids.astype(np.int64) + 1
+
+    def _to_device(self, indices):
+        """ Moves the numpy array `indices` to the embedding's device.
+        For CUDA, indices are staged in reused pinned memory and copied
+        asynchronously. """
+        device = self.embedding.weight.device
+        if device.type != 'cuda':
+            return torch.from_numpy(indices)
+        if self._staging_event is not None:
+            # Previous copy needs to finish before overwriting the staging
+            self._staging_event.synchronize()
+        if self._staging is None or self._staging.numel() < indices.size:
+            self._staging = torch.empty(indices.size, dtype=torch.long,
+                                        pin_memory=True)
+        staging = self._staging[:indices.size].view(indices.shape)
+        staging.copy_(torch.from_numpy(indices))
+        indices = staging.to(device, non_blocking=True)
+        self._staging_event = torch.cuda.Event()
+        self._staging_event.record()
+        return indices
+
+    def _lookup_embedding(self):
+        """ Returns the embedding to look up conditions in """
+        if self._embedding_copy is None:
+            return self.embedding
+        return self._embedding_copy
+
+    def _use_bags(self):
+        """ Whether list-of-list inputs are reduced by an `nn.EmbeddingBag`.
+        Sparse gradients are not supported for max-reduced bags, for which
+        the padded batch is embedded and reduced instead. """
+        return self.reduce is not None\
+            and not (self.sparse and self.reduce == 'max')
+
+    def _encode_bags(self, batch_inputs):
+        """ Embeds and reduces variable-length `batch_inputs` as bags """
+        lengths = np.fromiter(map(len, batch_inputs), dtype=np.int64,
+                              count=len(batch_inputs))
+        offsets = np.zeros(len(batch_inputs), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        # Offsets and indices are moved to the device in a single copy
+        packed = np.concatenate([offsets, *batch_inputs]).astype(np.int64,
+                                                                  copy=False)
+        packed = self._to_device(packed)
+        offsets, indices = packed[:len(batch_inputs)], packed[len(batch_inputs):]
+        return self._lookup_embedding()(indices, offsets)
 
     def _pad_batch(self, batch_inputs):
-        maxlen = max(len(l) for l in batch_inputs)
-        return [l + [self.padding_idx] * (maxlen - len(l)) for l in batch_inputs]
+        """ Returns int64 array of `batch_inputs` padded to equal length """
+        lengths = np.fromiter(map(len, batch_inputs), dtype=np.int64,
+                              count=len(batch_inputs))
+        padded = np.full((len(batch_inputs), lengths.max()), self.padding_idx,
+                         dtype=np.int64)
+        for i, (l, length) in enumerate(zip(batch_inputs, lengths)):
+            padded[i, :length] = l
+        return padded
 
     def encode(self, inputs):
-        if self.reduce is not None:
-            # inputs may have variable lengths, pad them
-            inputs = self._pad_batch(inputs)
-        inputs = torch.tensor(inputs, device=self.embedding.weight.device)
-        h = self.embedding(inputs)
-        if self.reduce is not None:
-            # self.reduce in ['mean','sum','max']
-            h = getattr(h, self.reduce)(1)
-        if self.use_cuda:
-            h = h.cuda()
+        if self._use_bags():
+            h = self._encode_bags(inputs)
+        else:
+            if self.reduce is not None:
+                # inputs may have variable lengths, pad them
+                inputs = self._pad_batch(inputs)
+            # No-op for padded inputs
+            inputs = self._to_device(np.ascontiguousarray(inputs,
+                                                          dtype=np.int64))
+            h = self._lookup_embedding()(inputs)
+            if self.reduce is not None:
+                # self.reduce == 'max' with sparse gradients, which
+                # ignores padding like `nn.EmbeddingBag`
+                padding = (inputs == self.padding_idx).unsqueeze(-1)
+                h = h.masked_fill(padding, float('-inf')).max(1)[0]
+                h = h.masked_fill(padding.all(1), 0.)
+        if self.dtype is not None:
+            # Downstream modules operate in float32
+            h = h.float()
         return h
 
     def zero_grad(self):
         self.optimizer.zero_grad()
+        if self._embedding_copy is not None:
+            self._embedding_copy.zero_grad()
 
     def step(self):
         # loss.backward() to be called before by client (such as in ae_step)
         # The condition object can update its own parameters wrt global loss
+        if self._embedding_copy is None:
+            self.optimizer.step()
+            return
+        master, lookup = self.embedding.weight, self._embedding_copy.weight
+        if lookup.grad is None:
+            return
+        # Update in float32, where small steps do not round away
+        master.grad = lookup.grad.float()
         self.optimizer.step()
+        with torch.no_grad():
+            if master.grad.is_sparse:
+                # Only the rows looked up have changed
+                rows = master.grad.coalesce().indices()[0]
+                lookup[rows] = master[rows].to(lookup.dtype)
+            else:
+                lookup.copy_(master)
 
     def size_increment(self):
         return self.embedding_dim
@@ -550,6 +1489,7 @@ class Condition(ConditionBase):
         self.optimizer = optimizer
         self.mode_ = mode
         self.dim = dim
+        self._size_increment = size_increment
 
     def fit(self, raw_inputs):
         if self.preprocessor is not None:
@@ -583,7 +1523,7 @@ class Condition(ConditionBase):
         return out
 
     def size_increment(self):
-        return self.size_increment
+        return self._size_increment
 
     def zero_grad(self):
         if self.optimizer is not None:
@@ -1,5 +1,8 @@
 """ UB General Purpose Library """
-from sklearn.feature_extraction.text import TfidfVectorizer
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
 
 
 class AutoEncoderMixin(object):
@@ -39,27 +42,62 @@ class EmbeddedVectorizer(TfidfVectorizer):
 
     """ Weighted Bag-of-embedded-Words"""
 
-    def __init__(self, embedding, index2word, **kwargs):
+    def __init__(self, embedding, index2word, embedding_dtype=np.float32,
+                 **kwargs):
         """
         Arguments
         ---------
 
         embedding: V x D embedding matrix
         index2word: list of words with indices matching V
+        embedding_dtype: dtype to store the embedding in, np.float16 halves
+            its memory footprint. Scores are always computed in float32.
         """
-        super(EmbeddedVectorizer, self).__init__(self, vocabulary=index2word,
+        super(EmbeddedVectorizer, self).__init__(vocabulary=index2word,
                                                  **kwargs)
-        self.embedding = embedding
+        self.index2word = index2word
+        self.embedding_dtype = embedding_dtype
+        # C-contiguous for the sparse @ dense product
+        self.embedding = np.ascontiguousarray(embedding, dtype=embedding_dtype)
 
     def fit(self, raw_documents, y=None):
         super(EmbeddedVectorizer, self).fit(raw_documents)
+        # Dense idf vector to scale the scores in place
+        self._idf = self.idf_.astype(np.float32) if self.use_idf else None
         return self
 
+    def _tfidf_scores(self, raw_documents):
+        """ Computes TF-IDF scores in CSR format by scaling the counts
+        in place, without the copy and checks of TfidfTransformer """
+        counts = CountVectorizer.transform(self, raw_documents).tocsr()
+        # Compute the weights in a single pass over the counts,
+        # then wrap them with the index arrays of the counts (no copy)
+        weights = counts.data.astype(np.float32)
+        if self.sublinear_tf:
+            np.log(weights, weights)
+            weights += 1
+        if self._idf is not None:
+            weights *= self._idf.take(counts.indices)
+        sparse_scores = sp.csr_matrix((weights, counts.indices, counts.indptr),
+                                      shape=counts.shape, copy=False)
+        if self.norm is not None:
+            sparse_scores = normalize(sparse_scores, norm=self.norm, copy=False)
+        return sparse_scores
+
     def transform(self, raw_documents, __y=None):
-        sparse_scores = super(EmbeddedVectorizer,
-                              self).transform(raw_documents)
-        # Xt is sparse counts
-        return sparse_scores @ self.embedding
+        sparse_scores = self._tfidf_scores(raw_documents)
+        embedding = self.embedding
+        if embedding.dtype != np.float32:
+            # Upcast only the rows of words that occur in the documents
+            words, indices = np.unique(sparse_scores.indices,
+                                       return_inverse=True)
+            sparse_scores = sp.csr_matrix(
+                (sparse_scores.data, indices, sparse_scores.indptr),
+                shape=(sparse_scores.shape[0], len(words)))
+            embedding = embedding[words].astype(np.float32)
+        # Xt is sparse counts, CSR @ dense runs row-wise without conversion
+        return np.ascontiguousarray(sparse_scores @ embedding,
+                                    dtype=np.float32)
 
     def fit_transform(self, raw_documents, y=None):
         return self.fit(raw_documents, y).transform(raw_documents, y)
@@ -77,6 +115,7 @@ class GensimEmbeddedVectorizer(EmbeddedVectorizer):
         ---------
         `gensim_vectors` is expected to have index2word and syn0 defined
         """
+        self.gensim_vectors = gensim_vectors
         index2word = gensim_vectors.index2word
         embedding = gensim_vectors.vectors
         super(GensimEmbeddedVectorizer, self).__init__(embedding,
@@ -1,14 +1,178 @@
 """ Auxiliary utilities """
+import logging
+import weakref
+from itertools import islice
+
 import numpy as np
-from sklearn.metrics import mutual_info_score
+import scipy.sparse as sp
+from scipy.special import xlogy
 from scipy.stats import entropy
 
-from .datasets import BagsWithVocab
-from .condition import ConditionList
+
+log = logging.getLogger(__name__)
+
+# Sparse array format where available (scipy >= 1.8), else sparse matrix
+_CSR = getattr(sp, 'csr_array', sp.csr_matrix)
+
+
+def _bags_cache(bags):
+    """ Returns the dict of matrices cached on `bags`. The cache is emptied
+    when the data or owners of `bags` changed since, as by `Bags.prune_`. """
+    state = (bags.data, len(bags.data), bags.bag_owners)
+    cache = getattr(bags, "_mi_cache", None)
+    if cache is None or cache['state'][0] is not state[0]\
+            or cache['state'][1] != state[1]\
+            or cache['state'][2] is not state[2]:
+        cache = bags._mi_cache = {'state': state}
+    return cache
+
+
+def _labels_csr(bags):
+    """ Returns the labels of `bags` in canonical CSR format. The matrix is
+    cached on `bags`, such that repeated calls convert only once. """
+    cache = _bags_cache(bags)
+    if 'labels' not in cache:
+        csr = bags.tocsr()
+        csr.sum_duplicates()
+        csr.sort_indices()
+        # Labels are counts, which are cheaper to multiply as integers
+        csr.data = csr.data.astype(np.int32)
+        if max(csr.nnz, *csr.shape) <= np.iinfo(np.int32).max:
+            # 32-bit indices halve the index traffic of the products
+            csr.indices = csr.indices.astype(np.int32, copy=False)
+            csr.indptr = csr.indptr.astype(np.int32, copy=False)
+        cache['labels'] = csr
+    return cache['labels']
+
+
+def _condition_data(bags, conditions):
+    """ Returns the condition data of `bags`, transformed by `conditions`.
+    It is cached on `bags` along with the labels, such that repeated calls
+    with the same conditions fit and transform only once. The cache is
+    renewed when any of the conditions was fit elsewhere in between.
+    Conditions that do not count their fits are not cached. """
+    fit_counts = tuple(getattr(c, '_fit_count', None)
+                       for c in conditions.values())
+    if None in fit_counts:
+        condition_data = bags.get_attributes(conditions.keys())
+        return conditions.fit_transform(condition_data)
+    cache = _bags_cache(bags)
+    key = ('conditions', tuple(conditions.keys()))
+    cached = cache.get(key)
+    # Conditions are referenced weakly, such that the cache does not keep
+    # them alive
+    if cached is None or cached[0]() is not conditions\
+            or cached[1] != fit_counts:
+        condition_data = bags.get_attributes(conditions.keys())
+        condition_data = conditions.fit_transform(condition_data)
+        fit_counts = tuple(c._fit_count for c in conditions.values())
+        cached = cache[key] = (weakref.ref(conditions), fit_counts,
+                               condition_data)
+    return cached[2]
+
+
+def _popcount(words):
+    """ Number of set bits along the last axis of uint64 array `words` """
+    if hasattr(np, 'bitwise_count'):
+        # numpy >= 2.0
+        return np.bitwise_count(words).sum(-1, dtype=np.int64)
+    return np.unpackbits(words.view(np.uint8), axis=-1).sum(-1, dtype=np.int64)
+
+
+def _use_bitsets(Y):
+    """ Whether the Gram matrix Y'Y is cheaper to count by popcounts over
+    bitsets of the columns of Y than by sparse multiplication. Requires
+    binary Y. The sparse product takes about sum_d |d|^2 operations for the
+    rows d of Y, popcounts of all pairs of columns n_labels^2 * n_rows / 64.
+    """
+    if Y.nnz == 0 or not (Y.data == 1).all():
+        return False
+    row_nnz = np.diff(Y.indptr).astype(np.float64)
+    n_rows, n_labels = Y.shape
+    return float(n_labels) ** 2 * np.ceil(n_rows / 64) < row_nnz.dot(row_nnz)
+
+
+def _gram_blocks_bitset(Y, max_words=2 ** 22):
+    """ Yields the Gram matrix Y'Y of binary CSR `Y` as CSR blocks of
+    consecutive rows. Each column of `Y` is packed into a bitset, such that
+    co-occurrence counts are popcounts of bitwise ands of 64 rows at once.
+    Blocks are sized such that at most `max_words` words are anded at once.
+    """
+    n_rows, n_labels = Y.shape
+    n_words = -(-n_rows // 64)
+    # Set the bit of each nonzero entry in the bitset of its column
+    row = np.repeat(np.arange(n_rows), np.diff(Y.indptr))
+    bits = np.zeros((n_labels, n_words * 8), dtype=np.uint8)
+    np.bitwise_or.at(bits, (Y.indices, row >> 3),
+                     np.left_shift(1, row & 7).astype(np.uint8))
+    bits = bits.view(np.uint64)
+    block_size = max(1, max_words // (n_labels * n_words))
+    for start in range(0, n_labels, block_size):
+        counts = _popcount(bits[start:start + block_size, None, :]
+                           & bits[None, :, :])
+        yield _CSR(counts)
+
+
+def _contingency_blocks(X, Y, block_size):
+    """ Yields the contingency table X'Y as canonical CSR blocks of at most
+    `block_size` consecutive rows (features), such that the full table is
+    never held in memory at once. """
+    # The transpose of CSC is CSR, such that CSR times CSR is computed
+    # without converting Y
+    Xc = X.tocsc()
+    if Xc.dtype.kind in 'biu':
+        # Count features, such that the contingency holds integer counts
+        Xc = Xc.astype(np.int32, copy=False)
+    for start in range(0, Xc.shape[1], block_size):
+        block = Xc[:, start:start + block_size].T.dot(Y).tocsr()
+        block.eliminate_zeros()
+        # Canonical format (sorted, no duplicates)
+        block.sum_duplicates()
+        yield block
+
+
+def _mi_from_blocks(blocks, symmetric=False):
+    """ Computes the mutual information (base e) from a sparse contingency
+    table, given as CSR blocks of consecutive rows, like
+    `sklearn.metrics.mutual_info_score`, but only operating on the nonzero
+    entries.
+    As the marginals are the row and column sums of the contingency,
+    MI = (sum v log v - sum pi log pi - sum pj log pj) / N + log N,
+    which needs only a single logarithm per nonzero entry v and can be
+    accumulated block by block.
+    If `symmetric` is True, the contingency is assumed to be symmetric,
+    such that the column sums equal the row sums. """
+    sum_vlogv, h_pi, n, pj = 0.0, 0.0, 0.0, None
+    for block in blocks:
+        nz_val = block.data.astype(np.float64)
+        if not nz_val.size:
+            continue
+        # Marginals by single passes over the CSR buffers. Empty rows and
+        # columns do not contribute and are left out.
+        indptr = block.indptr
+        pi = np.add.reduceat(nz_val, indptr[:-1][np.diff(indptr) > 0])
+        sum_vlogv += xlogy(nz_val, nz_val).sum()
+        h_pi += xlogy(pi, pi).sum()
+        n += pi.sum()
+        if not symmetric:
+            block_pj = np.bincount(block.indices, weights=nz_val,
+                                   minlength=block.shape[1])
+            pj = block_pj if pj is None else pj + block_pj
+    if n == 0:
+        return 0.0
+    h_pj = h_pi if symmetric else xlogy(pj, pj).sum()
+    mi = (sum_vlogv - h_pi - h_pj) / n + np.log(n)
+    return max(mi, 0.0)
+
+
+def _mi_from_csr(contingency, symmetric=False):
+    """ Computes the mutual information (base e) from a sparse contingency
+    table in CSR format, see `_mi_from_blocks` """
+    return _mi_from_blocks([contingency], symmetric=symmetric)
 
 
 def compute_mutual_info(bags, conditions=None, include_labels=True,
-                        normalize=True):
+                        normalize=True, block_size=10000, Y=None, X=None):
     """
     Arguments
     =========
@@ -16,56 +180,92 @@ def compute_mutual_info(bags, conditions=None, include_labels=True,
     :bags: BagsWithVocab instance
     :conditions: ConditionList instance
     :include_labels: if True, include labels in input
+    :block_size: number of features per block of the contingency table,
+                 bounds its memory
+    :Y: sparse labels of `bags`, if already built by the caller
+    :X: sparse features, if already built by the caller.
+        If given, `conditions` and `include_labels` are ignored.
 
     """
-    assert isinstance(bags, BagsWithVocab), "Expecting BagsWithVocab instance, apply vocab before"
-    assert conditions or include_labels, "If no conditions are give, include_labels should be True"
-    print("[MI]", "Put labels into csr format...")
-    Y = bags.tocsr()
-    print("[MI]", "Y shape (labels):", Y.shape)
+    # Duck-typed, such that importing this module does not import torch
+    assert hasattr(bags, 'tocsr') and hasattr(bags, 'get_attributes'),\
+        "Expecting BagsWithVocab instance, apply vocab before"
+    assert conditions or include_labels or X is not None,\
+        "If no conditions are give, include_labels should be True"
+    if Y is None:
+        log.info("[MI] Put labels into csr format...")
+        Y = _labels_csr(bags)
+    else:
+        Y = sp.csr_matrix(Y)
+    log.info("[MI] Y shape (labels): %s", Y.shape)
 
     # Number of different labels
     n_labels = np.asarray(Y.shape[1])
 
 
-    if conditions:
-        print("[MI] Using conditions:", list(conditions.keys()))
-        assert isinstance(conditions, ConditionList), "Expecting ConditionList instance"
-        print("[MI]", "Preprocessing condition data...")
-        condition_data = bags.get_attributes(conditions.keys())
-        condition_data = conditions.fit_transform(condition_data)
-        if include_labels:
+    if X is not None:
+        log.info("[MI] Using given features")
+    elif conditions:
+        log.info("[MI] Using conditions: %s", list(conditions.keys()))
+        assert hasattr(conditions, 'fit_transform')\
+            and hasattr(conditions, 'encode_impose'),\
+            "Expecting ConditionList instance"
+        # Conditions are given, so the condition module is loaded already
+        from .condition import CountCondition
+        log.info("[MI] Preprocessing condition data...")
+        condition_data = _condition_data(bags, conditions)
+        # Bag-of-words conditions append columns, so all of them can be
+        # stacked at once instead of reallocating per imposed condition
+        stackable = all(isinstance(cond, CountCondition)
+                        for cond in conditions.values())
+        if include_labels and stackable:
+            log.info("[MI] Stacking conditions with labels")
+            X = sp.hstack([Y, *conditions.encode(condition_data)],
+                          format='csr')
+        elif include_labels:
             # Impose condition on (input) labels
-            print("[MI]", "Imposing conditions on labels")
+            log.info("[MI] Imposing conditions on labels")
             X = conditions.encode_impose(Y, condition_data)
+        elif stackable:
+            log.info("[MI] Stacking condition data")
+            X = sp.hstack(conditions.encode(condition_data), format='csr')
         else:
-            print("[MI]", "Using only condition data")
+            log.info("[MI] Using only condition data")
             # Use *only* condition data to compute MI
             encoded_cdata = conditions.encode(condition_data)
-            remaining_conditions = list(conditions.values())[1:]
             X = encoded_cdata[0]
-            if remaining_conditions:
-                for cond, cdata in zip(remaining_conditions, encoded_cdata[1:]):
-                    # Impose all remaining conditions
-                    X = cond.impose(X, cdata)
+            remaining_conditions = islice(conditions.values(), 1, None)
+            for cond, cdata in zip(remaining_conditions,
+                                   islice(encoded_cdata, 1, None)):
+                # Impose all remaining conditions
+                X = cond.impose(X, cdata)
     else:
         X = Y
-    print("[MI]", "X shape (features):", X.shape)
+    log.info("[MI] X shape (features): %s", X.shape)
 
-    print("[MI]", "Computing contingency table...")
-    contingency = X.T @ Y  # [N_feats, N_labels]
-    print("[MI] contingency", contingency.shape, contingency.dtype)
+    # Without conditions, the contingency is the symmetric Gram matrix Y'Y
+    symmetric = X is Y
+    # Sparse arrays reduce to plain ndarrays instead of np.matrix
+    X = _CSR(X)
+    Y = X if symmetric else _CSR(Y)
 
-    print("[MI]", "Computing mutual information...")
-    mi = mutual_info_score(None, None, contingency=contingency)
+    log.info("[MI] Computing mutual information from contingency table"
+             " in blocks of %d features...", block_size)
+    # [N_feats, N_labels] contingency table, computed block by block
+    if symmetric and _use_bitsets(Y):
+        log.info("[MI] Counting label co-occurrences with bitsets")
+        contingency = _gram_blocks_bitset(Y)
+    else:
+        contingency = _contingency_blocks(X, Y, block_size)
+    mi = _mi_from_blocks(contingency, symmetric=symmetric)
 
-    print("[MI]", "Mutual information (base e):", mi)
+    log.info("[MI] Mutual information (base e): %s", mi)
     if normalize:
-        print("[MI]", "Computing label entropy...")
+        log.info("[MI] Computing label entropy...")
         # Entropy of column-sums of labels
-        h_features = entropy(np.asarray(X.sum(0)).ravel())
+        h_features = entropy(np.ravel(X.sum(0)))
         # Normalize by entropy
-        print("[MI]", "Normalizing with feature entropy:", h_features)
+        log.info("[MI] Normalizing with feature entropy: %s", h_features)
         mi = mi / h_features
-        print("[MI]", "Normalized Mutual information (base e):", mi)
+        log.info("[MI] Normalized Mutual information (base e): %s", mi)
     return mi
@@ -5,6 +5,7 @@ Theory: https://nlp.stanford.edu/IR-book/html/htmledition/mutual-information-1.h
 Impl Docs: https://scikit-learn.org/stable/modules/generated/sklearn.metrics.mutual_info_score.html
 """
 import argparse
+import logging
 
 import numpy as np
 from sklearn.metrics import mutual_info_score
@@ -22,6 +23,9 @@ PARSER.add_argument('-M', '--max-features', type=int,
                     help='Max features', default=None)
 ARGS = PARSER.parse_args()
 
+# Show progress of computing the mutual information
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
 
 # MI_CONDITIONS = ConditionList([('title', CountCondition(max_features=100000))])
 MI_CONDITIONS = None
@@ -73,7 +73,7 @@ CONDITIONS = ConditionList([
     ('title', PretrainedWordEmbeddingCondition(VECTORS)),
     ('venue', PretrainedWordEmbeddingCondition(VECTORS)),
     ('author', CategoricalCondition(embedding_dim=32, reduce="sum", # vocab_size=0.01,
-                                    sparse=True, embedding_on_gpu=True))
+                                    sparse=True))
 ])
 
 # Model with metadata (metadata used as set in CONDITIONS above)
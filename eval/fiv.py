@@ -75,7 +75,7 @@ RECOMMENDERS = [
 CONDITIONS = ConditionList([
     ('title', PretrainedWordEmbeddingCondition(VECTORS)),
 #    ('author', CategoricalCondition(embedding_dim=32, reduce="sum",
-#                                    sparse=True, embedding_on_gpu=True))
+#                                    sparse=True))
 ])
 
 # Model with metadata (metadata used as set in CONDITIONS above)
@@ -52,7 +52,7 @@ DATA_PATH = "/data21/lgalke/datasets/MPD/data/"
 CONDITIONS = ConditionList([
     ('name', PretrainedWordEmbeddingCondition(VECTORS)),
     ('artist_name', CategoricalCondition(embedding_dim=32, reduce="sum", # vocab_size=0.01,
-                                         sparse=True, embedding_on_gpu=True)),
+                                         sparse=True)),
     ('track_name', PretrainedWordEmbeddingCondition(VECTORS)),
     ('album_name', PretrainedWordEmbeddingCondition(VECTORS))
 ])
@@ -104,9 +104,9 @@ CONDITIONS = ConditionList([
     ('title', PretrainedWordEmbeddingCondition(VECTORS)) #,
 #     ('journal', CategoricalCondition(embedding_dim=32, reduce=None)),
 #     ('author', CategoricalCondition(embedding_dim=32, reduce="sum",
-#                                     sparse=True, embedding_on_gpu=True)),
+#                                     sparse=True)),
 #     ('mesh', CategoricalCondition(embedding_dim=32, reduce="sum",
-#                                   sparse=True, embedding_on_gpu=True))
+#                                   sparse=True))
 ])
 
 # Model with metadata (metadata used as set in CONDITIONS above)
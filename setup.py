@@ -3,8 +3,8 @@ from setuptools import setup
 requirements = [
       'numpy',
       'scipy',
-      'sklearn',
-      'torch',
+      'scikit-learn>=1.0',
+      'torch>=2.0',
       'gensim',
       'pandas',
       'joblib',
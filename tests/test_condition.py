@@ -12,7 +12,11 @@ from aaerec.condition import EmbeddingBagCondition,\
     ConditionalScaling,\
     CategoricalCondition,\
     Condition,\
-    ConditionList
+    ConditionList,\
+    CountCondition,\
+    FiLMCondition,\
+    MultiFieldEmbeddingBagCondition,\
+    _thread_pool
 
 
 def test_condition_abc():
@@ -46,6 +50,52 @@ def test_condition_simple():
     assert code.size(0) == conditioned_code.size(0)
 
 
+def test_quantized_condition():
+    """ Test that int8 quantized lookups approximate the float ones """
+    c_batch = torch.randint(0, 20, (100, 3))
+    ebc = EmbeddingBagCondition(20, 10)
+    expected = ebc.encode(c_batch)
+
+    ebc.quantize_for_inference()
+    quantized = ebc.encode(c_batch)
+
+    assert quantized.size() == expected.size()
+    assert ((quantized - expected).abs() < 0.05).all()
+
+
+def test_multi_field_condition():
+    """ Test that fields share one embedding bag but disjoint embeddings """
+    code = torch.rand(100, 10)
+    f1_batch = torch.randint(0, 3, (100, 2))
+    f2_batch = torch.randint(0, 5, (100, 4))
+    mfc = MultiFieldEmbeddingBagCondition([3, 5], 10)
+    assert mfc.size_increment() == 20
+
+    encoded = mfc.encode([f1_batch, f2_batch])
+    weight = mfc.embedding_bag.weight
+    expected = torch.cat([weight[f1_batch].mean(1),
+                          weight[f2_batch + 3].mean(1)], 1)
+    assert ((encoded - expected).abs() < 1e-6).all()
+
+    conditioned_code = mfc.impose(code, encoded)
+    assert conditioned_code.size(1) == code.size(1) + mfc.size_increment()
+
+
+def test_bfloat16_condition():
+    """ Test that bfloat16 lookups approximate the float ones """
+    code = torch.rand(100, 10)
+    c_batch = torch.randint(0, 20, (100, 3))
+    ebc = EmbeddingBagCondition(20, 10)
+    expected = ebc.encode_impose(code, c_batch)
+
+    ebc.cast_for_inference(torch.bfloat16)
+    conditioned_code = ebc.encode_impose(code, c_batch)
+
+    # Promoted to float32 by concatenation
+    assert conditioned_code.dtype == torch.float32
+    assert ((conditioned_code - expected).abs() < 0.05).all()
+
+
 def test_condition_list():
     """ Test list of conditions """
     code = torch.rand(100, 10)
@@ -78,6 +128,158 @@ def test_condition_list():
     assert code.size(0) == conditioned_code.size(0)
 
 
+def test_condition_list_fused_concat():
+    """ Test that the fused concatenation matches sequential imposing """
+    code = torch.rand(100, 10)
+    c1_batch = (torch.rand(100, 2) < 0.5).long()
+    c2_batch = (torch.rand(100, 2) < 0.5).long()
+    condition_list = ConditionList([
+        ('title', EmbeddingBagCondition(2, 10)),
+        ('something', EmbeddingBagCondition(2, 5))
+    ])
+
+    expected = condition_list.encode_impose(code, [c1_batch, c2_batch])
+    fused = condition_list.encode_impose_fused(code, [c1_batch, c2_batch])
+
+    assert fused.size() == expected.size()
+    assert ((fused - expected).abs() < 1e-8).all()
+
+    # Gradients should still reach the embedding bags
+    fused.sum().backward()
+    assert condition_list['something'].embedding_bag.weight.grad is not None
+
+
+def test_condition_list_fused_concat_sparse():
+    """ Test that the fused concatenation keeps sparse gradients """
+    code = torch.rand(100, 10)
+    c_batch = (torch.rand(100, 2) < 0.5).long()
+    condition = EmbeddingBagCondition(5, 3, sparse=True)
+    condition_list = ConditionList([('a', condition)])
+
+    expected = condition_list.encode_impose(code, [c_batch])
+    fused = condition_list.encode_impose_fused(code, [c_batch])
+    assert ((fused - expected).abs() < 1e-8).all()
+
+    condition_list.zero_grad()
+    fused.sum().backward()
+    assert condition.embedding_bag.weight.grad.is_sparse
+    condition_list.step()
+
+
+def test_film_condition():
+    """ Test feature-wise linear modulation and scale/bias pair fusion """
+    code = torch.rand(100, 10)
+    c_batch = torch.rand(100, 3)
+
+    film = FiLMCondition(3, 10, use_cuda=False)
+    assert isinstance(film, ConditionBase)
+    scale, bias = film.encode(c_batch)
+    conditioned_code = film.impose(code, (scale, bias))
+    assert conditioned_code.size() == code.size()
+    assert ((conditioned_code - (code * scale + bias)).abs() < 1e-6).all()
+
+    class Scaling(ConditionalScaling):
+        def encode(self, inputs):
+            return inputs
+
+    class Biasing(ConditionalBiasing):
+        def encode(self, inputs):
+            return inputs
+
+    scale, bias = torch.rand(100, 10), torch.rand(100, 10)
+    condition_list = ConditionList([('scale', Scaling()), ('bias', Biasing())])
+    conditioned_code = condition_list.encode_impose(code, [scale, bias])
+    assert ((conditioned_code - (code * scale + bias)).abs() < 1e-6).all()
+
+    # Pairs with custom encode_impose are not fused
+    class DoubleBiasing(Biasing):
+        def encode_impose(self, inputs, condition_input, dim=None):
+            return inputs + 2 * self.encode(condition_input)
+
+    condition_list = ConditionList([('scale', Scaling()),
+                                    ('bias', DoubleBiasing())])
+    conditioned_code = condition_list.encode_impose(code, [scale, bias])
+    assert ((conditioned_code - (code * scale + 2 * bias)).abs() < 1e-6).all()
+
+
+def test_inplace_imposing():
+    """ Test that in-place biasing and scaling in a list keeps gradients """
+    class Biasing(ConditionalBiasing):
+        def encode(self, inputs):
+            return inputs
+
+    code = torch.rand(100, 10, requires_grad=True)
+    c_batch = (torch.rand(100, 2) < 0.5).long()
+    bias = torch.rand(100, 20, requires_grad=True)
+    ebc = EmbeddingBagCondition(2, 10)
+    biasing = Biasing()
+    condition_list = ConditionList([('title', ebc), ('bias', biasing)])
+
+    conditioned_code = condition_list.encode_impose(code, [c_batch, bias])
+    expected = torch.cat([code, ebc.encode(c_batch)], 1) + bias
+    assert ((conditioned_code - expected).abs() < 1e-6).all()
+
+    conditioned_code.sum().backward()
+    assert ((bias.grad - 1).abs() < 1e-6).all()
+    assert ((code.grad - 1).abs() < 1e-6).all()
+
+    # Outside of the list, the inputs are left untouched
+    hidden = code * 2
+    before = hidden.detach().clone()
+    biasing.impose(hidden, torch.ones(100, 10))
+    assert (hidden == before).all()
+
+
+def test_inplace_imposing_custom_condition():
+    """ Test that outputs of custom conditions are not modified in-place """
+    class Tanh(ConditionalBiasing):
+        def encode(self, inputs):
+            return inputs
+
+        def impose(self, inputs, encoded_condition, dim=None):
+            # tanh saves its output for backward
+            return torch.tanh(inputs + encoded_condition)
+
+    class Scaling(ConditionalScaling):
+        def encode(self, inputs):
+            return inputs
+
+    code = torch.rand(100, 10, requires_grad=True)
+    bias = torch.rand(100, 10)
+    scale = torch.rand(100, 10, requires_grad=True)
+    condition_list = ConditionList([('tanh', Tanh()), ('scale', Scaling())])
+
+    conditioned_code = condition_list.encode_impose(code, [bias, scale])
+    expected = torch.tanh(code + bias) * scale
+    assert ((conditioned_code - expected).abs() < 1e-6).all()
+    conditioned_code.sum().backward()
+    assert code.grad is not None and scale.grad is not None
+
+
+def test_condition_list_concat_buffers():
+    """ Test training with persistent output buffers of varying batch size """
+    code = torch.rand(100, 10)
+    c_batch = (torch.rand(100, 2) < 0.5).long()
+    condition_list = ConditionList([('title', EmbeddingBagCondition(2, 10))])
+    condition_list.set_max_batch(64)
+
+    losses = []
+    for start in [0, 64, 0, 64]:
+        end = start + 64
+        condition_list.zero_grad()
+        expected = condition_list.encode_impose(code[start:end],
+                                                [c_batch[start:end]])
+        fused = condition_list.encode_impose_fused(code[start:end],
+                                                   [c_batch[start:end]])
+        assert ((fused - expected).abs() < 1e-8).all()
+        loss = (fused ** 2).mean()
+        loss.backward()
+        losses.append(loss.item())
+        condition_list.step()
+
+    assert losses[2] < losses[0]
+
+
 def test_optim_step_callback():
     """ Test zero_grad / step optimization """
     code = torch.rand(100, 10)
@@ -103,6 +305,184 @@ def test_optim_step_callback():
     assert losses[1] < losses[0]
 
 
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Requires CUDA")
+def test_condition_list_capture_step():
+    """ Test capturing a training step after steps on the optimizer stream """
+    code = torch.rand(100, 10, device='cuda')
+    c_batch = (torch.rand(100, 2, device='cuda') < 0.5).long()
+    condition_list = ConditionList([
+        ('title', EmbeddingBagCondition(2, 10, device='cuda'))])
+    target = torch.zeros(100, 20, device='cuda')
+
+    def loss_fn(conditioned_code):
+        return torch.nn.functional.mse_loss(conditioned_code, target)
+
+    # A normal step leaves pending work on the optimizer stream
+    condition_list.zero_grad()
+    loss_fn(condition_list.encode_impose(code, [c_batch])).backward()
+    condition_list.step()
+
+    graph, static_loss = condition_list.capture_step(code, [c_batch], loss_fn)
+    losses = []
+    for __ in range(3):
+        graph.replay()
+        losses.append(static_loss.item())
+    assert losses[-1] < losses[0]
+
+
+def test_condition_list_nested():
+    """ Test imposing variable-length bags given as nested tensor """
+    code = torch.rand(3, 10)
+    bags = [torch.tensor([0, 1]), torch.tensor([2]), torch.tensor([1, 2, 3])]
+    nested = torch.nested.nested_tensor(bags, layout=torch.jagged)
+    ebc = EmbeddingBagCondition(4, 5)
+    condition_list = ConditionList([('authors', ebc)])
+
+    conditioned_code = condition_list.encode_impose_nested(code, [nested])
+    assert conditioned_code.size() == (3, 15)
+    for i, bag in enumerate(bags):
+        expected = ebc.embedding_bag.weight[bag].mean(0)
+        assert ((conditioned_code[i, 10:] - expected).abs() < 1e-6).all()
+
+
+def test_condition_list_modification():
+    """ Test that conditions added after construction are imposed """
+    code = torch.rand(100, 10)
+    c_batch = (torch.rand(100, 2) < 0.5).long()
+    condition_list = ConditionList([('title', EmbeddingBagCondition(2, 10))])
+    condition_list['something'] = EmbeddingBagCondition(2, 5)
+
+    conditioned_code = condition_list.encode_impose(code, [c_batch, c_batch])
+    assert conditioned_code.size(1) == 25
+
+    title = condition_list['title']
+    del condition_list['title']
+    conditioned_code = condition_list.encode_impose(code, [c_batch])
+    assert conditioned_code.size(1) == 15
+
+    assert condition_list.size_increment() == 5
+
+    # The removed condition is optimized on its own again
+    assert title.optimizer is not None
+    assert all(p is not title.embedding_bag.weight
+               for group in condition_list.optimizer.param_groups
+               for p in group['params'])
+    weight = title.embedding_bag.weight.detach().clone()
+    title.zero_grad()
+    title.encode(c_batch).pow(2).sum().backward()
+    title.step()
+    assert not torch.equal(title.embedding_bag.weight, weight)
+
+
+def test_condition_list_reordering():
+    """ Test that conditions are imposed in their current order """
+    class Biasing(ConditionalBiasing):
+        def encode(self, inputs):
+            return inputs
+
+    class Scaling(ConditionalScaling):
+        def encode(self, inputs):
+            return inputs
+
+    code = torch.rand(100, 10)
+    bias, scale = torch.rand(100, 10), torch.rand(100, 10)
+    condition_list = ConditionList([('bias', Biasing()),
+                                    ('scale', Scaling())])
+    conditioned_code = condition_list.encode_impose(code, [bias, scale])
+    assert torch.allclose(conditioned_code, (code + bias) * scale)
+
+    condition_list.move_to_end('bias')
+    conditioned_code = condition_list.encode_impose(code, [scale, bias])
+    assert torch.allclose(conditioned_code, code * scale + bias)
+
+    condition_list.pop('bias')
+    conditioned_code = condition_list.encode_impose(code, [scale])
+    assert torch.allclose(conditioned_code, code * scale)
+
+    condition_list.clear()
+    assert condition_list.encode_impose(code, []) is code
+
+
+def test_condition_list_shared_condition():
+    """ Test that a condition in two lists is optimized by one of them """
+    ebc = EmbeddingBagCondition(2, 10)
+    first = ConditionList([('a', ebc)])
+    second = ConditionList([('a', ebc)])
+    assert first.optimizer is not None and second.optimizer is None
+
+    # Discarding the optimizing list hands back the optimizer
+    del first
+    import gc
+    gc.collect()
+    assert ebc.optimizer is not None
+
+
+def test_condition_list_size_increment_refit():
+    """ Test that the cached size increment is renewed on fitting """
+    condition_list = ConditionList([('text', CountCondition())])
+    condition_list.fit([["spam ham"]])
+    assert condition_list.size_increment() == 2
+    condition_list.fit_transform([["spam ham eggs"]])
+    assert condition_list.size_increment() == 3
+
+
+def test_condition_list_joint_optimizer():
+    """ Test that condition list optimizes embedding bags jointly """
+    code = torch.rand(100, 10)
+    c1_batch = (torch.rand(100, 2) < 0.5).long()
+    c2_batch = (torch.rand(100, 2) < 0.5).long()
+    ebc1 = EmbeddingBagCondition(2, 10)
+    ebc2 = EmbeddingBagCondition(2, 10)
+    condition_list = ConditionList([('a', ebc1), ('b', ebc2)])
+
+    # Conditions hand over their optimizers to the condition list
+    assert ebc1.optimizer is None and ebc2.optimizer is None
+    assert condition_list.optimizer is not None
+
+    target = torch.zeros(100, 30)
+    losses = []
+    for _ in range(2):
+        condition_list.zero_grad()
+        conditioned_code = condition_list.encode_impose(code,
+                                                        [c1_batch, c2_batch])
+        loss = torch.nn.functional.mse_loss(conditioned_code, target)
+        loss.backward()
+        losses.append(loss.item())
+        condition_list.step()
+
+    assert losses[1] < losses[0]
+
+    # Conditions cast for inference leave the joint optimizer
+    ebc2.cast_for_inference()
+    assert all(p is not ebc2.embedding_bag.weight
+               for group in condition_list.optimizer.param_groups
+               for p in group['params'])
+    assert ebc1.optimizer is None and ebc2.optimizer is None
+
+
+def test_sparse_embedding_bag_condition():
+    """ Test optimization of embedding bags with sparse gradients """
+    code = torch.rand(100, 10)
+    c_batch = (torch.rand(100, 2) < 0.5).long()
+    ebc = EmbeddingBagCondition(2, 10, sparse=True)
+    condition_list = ConditionList([('title', ebc)])
+    # Sparse embedding bags are not optimized jointly
+    assert condition_list.optimizer is None
+
+    target = torch.zeros(100, 20)
+    losses = []
+    for _ in range(2):
+        condition_list.zero_grad()
+        conditioned_code = condition_list.encode_impose(code, [c_batch])
+        loss = torch.nn.functional.mse_loss(conditioned_code, target)
+        loss.backward()
+        assert ebc.embedding_bag.weight.grad.is_sparse
+        losses.append(loss.item())
+        condition_list.step()
+
+    assert losses[1] < losses[0]
+
+
 def test_word_emb_condition():
     import gensim
     sentences = [
@@ -222,6 +602,33 @@ def test_categorical_condition_unk_treatment():
 
 
 
+def test_categorical_condition_mixed_items():
+    """ Test that items are not coerced to a common type """
+    catcond = CategoricalCondition(4, use_cuda=False)
+    ids = catcond.fit_transform([1, "1", "a", 1])
+    assert list(ids) == [1, 2, 3, 1]
+
+    # Missing attributes are items as well
+    catcond = CategoricalCondition(4, use_cuda=False)
+    ids = catcond.fit_transform([None, "a", "b", None, "a"])
+    assert list(ids) == [1, 2, 3, 1, 2]
+    assert list(catcond.transform(["b", None, "c"])) == [3, 1, 0]
+
+
+def test_categorical_condition_vocab_ties():
+    """ Test that ties are ranked by first occurrence, as by
+    `Counter.most_common` """
+    from collections import Counter
+    items = ["d", "c", "b", "a", "b", "e", "c", "a", "f", "d", "a"]
+    for vocab_size in range(1, 7):
+        catcond = CategoricalCondition(4, vocab_size=vocab_size,
+                                       use_cuda=False)
+        catcond.fit(items)
+        expected = [item for item, __ in
+                    Counter(items).most_common(vocab_size)]
+        assert sorted(catcond.vocab, key=catcond.vocab.get) == expected
+
+
 def test_categorical_condition_sparse():
     authors = ["A", "A", "B", "B", "C"]
     catcond = CategoricalCondition(20, use_cuda=False,
@@ -267,6 +674,56 @@ def test_categorical_condition_listoflists():
 
     assert (enc_authors_2.abs().sum() < enc_authors_1.abs().sum()).all()
 
+def test_categorical_condition_reduce():
+    authors = [["A", "B"], ["A"], ["B", "C", "A"], []]
+    for reduce in ['mean', 'sum', 'max']:
+        for sparse in [True, False]:
+            catcond = CategoricalCondition(8, use_cuda=False, sparse=sparse,
+                                           reduce=reduce)
+            author_ids = catcond.fit_transform(authors)
+            enc_authors = catcond.encode(author_ids)
+            assert enc_authors.size() == (len(authors), 8)
+            weight = catcond.embedding.weight
+            for ids, enc in zip(author_ids[:-1], enc_authors[:-1]):
+                expected = getattr(weight[torch.from_numpy(ids)], reduce)(0)
+                if reduce == 'max':
+                    expected = expected[0]
+                assert torch.allclose(enc, expected, atol=1e-6)
+            # Empty bag is encoded as zero
+            assert (enc_authors[-1] == 0).all()
+            # No inputs, no bags
+            assert len(catcond.transform([])) == 0
+
+
+def test_categorical_condition_bfloat16():
+    authors = [["A", "B"], ["A"], ["B", "C", "A"]]
+    catcond = CategoricalCondition(8, use_cuda=False, reduce='mean',
+                                   dtype=torch.bfloat16)
+    author_ids = catcond.fit_transform(authors)
+    # Trained in float32, looked up in bfloat16
+    assert catcond.embedding.weight.dtype == torch.float32
+    assert catcond._embedding_copy.weight.dtype == torch.bfloat16
+
+    enc_authors_1 = catcond.encode(author_ids)
+    assert enc_authors_1.dtype == torch.float32
+
+    master_1 = catcond.embedding.weight.detach().clone()
+    loss = enc_authors_1.pow(2).sum()
+    catcond.zero_grad()
+    loss.backward()
+    catcond.step()
+
+    # Encoded authors should now be closer to zero
+    enc_authors_2 = catcond.encode(author_ids)
+    assert enc_authors_2.abs().sum() < enc_authors_1.abs().sum()
+
+    # Steps smaller than the bfloat16 resolution are not lost
+    master_2 = catcond.embedding.weight.detach()
+    assert (master_2[1:] != master_1[1:]).all()
+    assert torch.equal(catcond._embedding_copy.weight.detach(),
+                       master_2.to(torch.bfloat16))
+
+
 def test_categorical_condition_with_sklearn_shuffle():
     authors = [["A","B"],
                ["A", "C"],
@@ -297,6 +754,24 @@ def test_categorical_condition_with_sklearn_shuffle():
 
 
 
+def test_count_condition():
+    """ Test imposing bag-of-words conditions on sparse labels """
+    import scipy.sparse as sp
+    documents = ["Spam Spam Spam", "Ham and cheese", "", "Cookies Spam"]
+    labels = sp.random(4, 6, density=0.5, format='csr')
+
+    condition = CountCondition()
+    encoded = condition.encode(condition.fit_transform(documents))
+    conditioned = condition.impose(labels, encoded)
+
+    assert encoded.dtype == np.uint8
+    assert conditioned.dtype == labels.dtype
+    assert conditioned.has_sorted_indices
+    assert conditioned.shape == (4, 6 + condition.size_increment())
+    expected = sp.hstack([labels, encoded]).toarray()
+    assert np.allclose(conditioned.toarray(), expected)
+
+
 def test_assemble_condition():
     documents = [
         "Spam Spam Spam",
@@ -318,6 +793,7 @@ def test_assemble_condition():
     def enc_fn(x):
         return encoder(torch.FloatTensor(x.toarray()))
     condition = Condition(tfidf, enc_fn, optimizer, size_increment=2)
+    assert condition.size_increment() == 2
 
     criterion = torch.nn.CrossEntropyLoss()
 
@@ -328,3 +804,31 @@ def test_assemble_condition():
         loss.backward()
         condition.step()
 
+
+
+def test_condition_list_threads():
+    """ Test that condition lists share their worker threads """
+    import threading
+    documents = [["spam ham"], ["eggs spam"]]
+
+    def transform_with_new_list():
+        conditions = ConditionList([('a', CountCondition()),
+                                    ('b', CountCondition())])
+        return conditions.fit(documents).transform(documents)
+
+    n_threads = threading.active_count()
+    for __ in range(50):
+        transform_with_new_list()
+    # Threads are bounded by the shared pool, not by the number of lists
+    assert threading.active_count() <= n_threads + _thread_pool()._max_workers
+
+
+def test_condition_list_encode_no_grad():
+    """ Test that encoding respects the caller's grad mode """
+    conditions = ConditionList([
+        ('a', CategoricalCondition(4, use_cuda=False)),
+        ('b', CategoricalCondition(4, use_cuda=False))])
+    inputs = conditions.fit_transform([["x", "y"], ["y", "z"]])
+    with torch.no_grad():
+        encoded = conditions.encode(inputs)
+    assert not any(out.requires_grad for out in encoded)
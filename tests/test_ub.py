@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from aaerec.ub import EmbeddedVectorizer
+
+DOCUMENTS = [
+    "spam spam spam",
+    "ham and cheese",
+    "cookies and spam and ham",
+    "nothing else but cookies",
+    "",
+    "eggs"
+]
+
+WORDS = ["spam", "ham", "and", "cheese", "cookies", "nothing", "else", "but"]
+
+
+@pytest.mark.parametrize("params", [
+    {},
+    {'sublinear_tf': True},
+    {'use_idf': False},
+    {'norm': None},
+    {'norm': 'l1', 'smooth_idf': False},
+])
+def test_embedded_vectorizer(params):
+    """ Test embedded scores against TF-IDF times embedding """
+    embedding = np.random.RandomState(0).rand(len(WORDS), 5)
+    vectorizer = EmbeddedVectorizer(embedding, WORDS, **params)
+    embedded = vectorizer.fit_transform(DOCUMENTS)
+
+    tfidf = TfidfVectorizer(vocabulary=WORDS, **params)
+    expected = tfidf.fit_transform(DOCUMENTS) @ embedding
+    assert embedded.dtype == np.float32
+    assert embedded.flags['C_CONTIGUOUS']
+    assert np.allclose(embedded, expected, atol=1e-6)
+
+
+def test_embedded_vectorizer_float16():
+    """ Test embedded scores with an embedding stored in half precision """
+    embedding = np.random.RandomState(0).rand(len(WORDS), 5)
+    vectorizer = EmbeddedVectorizer(embedding, WORDS,
+                                    embedding_dtype=np.float16)
+    assert vectorizer.embedding.dtype == np.float16
+    embedded = vectorizer.fit_transform(DOCUMENTS)
+    # Later documents only touch some of the words
+    embedded_subset = vectorizer.transform(DOCUMENTS[3:])
+
+    tfidf = TfidfVectorizer(vocabulary=WORDS).fit(DOCUMENTS)
+    half = embedding.astype(np.float16).astype(np.float32)
+    assert embedded.dtype == np.float32
+    assert np.allclose(embedded, tfidf.transform(DOCUMENTS) @ half, atol=1e-6)
+    assert np.allclose(embedded_subset, tfidf.transform(DOCUMENTS[3:]) @ half,
+                       atol=1e-6)
@@ -0,0 +1,123 @@
+import numpy as np
+import scipy.sparse as sp
+from sklearn.metrics import mutual_info_score
+
+from aaerec.condition import ConditionList, CountCondition
+from aaerec.datasets import BagsWithVocab
+from aaerec.utils import compute_mutual_info, _mi_from_csr,\
+    _mi_from_blocks, _contingency_blocks, _gram_blocks_bitset, _use_bitsets
+
+
+def test_mi_from_csr():
+    """ Test sparse mutual information against sklearn """
+    rng = np.random.RandomState(42)
+    contingency = sp.random(30, 20, density=0.2, format='csr', random_state=rng,
+                            data_rvs=lambda n: rng.randint(1, 10, n))
+    contingency = contingency.astype(np.int32)
+    expected = mutual_info_score(None, None, contingency=contingency)
+    assert np.isclose(_mi_from_csr(contingency), expected)
+
+
+def test_mi_from_csr_empty_rows():
+    """ Test sparse mutual information with empty rows and columns """
+    contingency = sp.csr_matrix(np.array([[0, 0, 0],
+                                          [3, 0, 1],
+                                          [0, 0, 0],
+                                          [1, 0, 2],
+                                          [0, 0, 0]], dtype=np.int32))
+    expected = mutual_info_score(None, None, contingency=contingency)
+    assert np.isclose(_mi_from_csr(contingency), expected)
+    assert _mi_from_csr(sp.csr_matrix((4, 3), dtype=np.int32)) == 0
+
+
+def test_mi_from_csr_symmetric():
+    """ Test sparse mutual information of a Gram matrix """
+    labels = sp.random(50, 10, density=0.3, format='csr', random_state=0)
+    labels.data[:] = 1
+    contingency = (labels.T @ labels).tocsr().astype(np.int32)
+    expected = mutual_info_score(None, None, contingency=contingency)
+    assert np.isclose(_mi_from_csr(contingency, symmetric=True), expected)
+
+
+def test_mi_blocks():
+    """ Test that blocking the contingency does not change the result """
+    rng = np.random.RandomState(0)
+    X = sp.random(100, 25, density=0.2, format='csr', random_state=rng)
+    X.data[:] = 1
+    Y = sp.random(100, 10, density=0.3, format='csr', random_state=rng)
+    Y.data[:] = 1
+    expected = _mi_from_csr((X.T @ Y).tocsr())
+    for block_size in [1, 7, 25]:
+        blocks = _contingency_blocks(X, Y, block_size)
+        assert np.isclose(_mi_from_blocks(blocks), expected)
+
+
+def test_mi_condition_cache(monkeypatch):
+    """ Test that condition data is transformed once per bags """
+    owners = list(range(4))
+    titles = ["spam ham", "ham", "eggs spam", "spam"]
+    bags = BagsWithVocab([[0, 1], [1], [0, 2], [2]], {i: i for i in range(3)},
+                         owners=owners,
+                         attributes={'title': dict(zip(owners, titles))})
+    conditions = ConditionList([('title', CountCondition())])
+    calls = []
+    fit_transform = conditions.fit_transform
+    monkeypatch.setattr(conditions, 'fit_transform',
+                        lambda data: calls.append(data) or fit_transform(data))
+    mi = compute_mutual_info(bags, conditions)
+    assert compute_mutual_info(bags, conditions) == mi
+    assert len(calls) == 1
+
+    # Refitting the conditions elsewhere renews the cached condition data
+    conditions.fit([titles])
+    compute_mutual_info(bags, conditions)
+    assert len(calls) == 2
+    compute_mutual_info(bags, conditions)
+    assert len(calls) == 2
+
+    # So does refitting a single condition
+    conditions['title'].fit(titles)
+    compute_mutual_info(bags, conditions)
+    assert len(calls) == 3
+
+    # Pruning renews the cached condition data along with the labels
+    bags.prune_(min_elements=2)
+    compute_mutual_info(bags, conditions)
+    assert len(calls) == 4
+    assert len(calls[-1][0]) == 2
+
+
+def test_mi_prebuilt_matrices():
+    """ Test that given labels and features are used as is """
+    owners = list(range(4))
+    bags = BagsWithVocab([[0, 1], [1], [0, 2], [2]], {i: i for i in range(3)},
+                         owners=owners)
+    Y = bags.tocsr()
+    mi = compute_mutual_info(bags)
+    assert np.isclose(compute_mutual_info(bags, Y=Y), mi)
+    assert np.isclose(compute_mutual_info(bags, Y=Y, X=Y), mi)
+
+
+def test_gram_blocks_bitset():
+    """ Test counting label co-occurrences with bitsets """
+    labels = sp.random(130, 7, density=0.4, format='csr', random_state=0)
+    labels.data[:] = 1
+    labels = labels.astype(np.int32)
+    assert _use_bitsets(labels)
+    expected = (labels.T @ labels).toarray()
+    for max_words in [1, 10, 2 ** 22]:
+        blocks = list(_gram_blocks_bitset(labels, max_words=max_words))
+        assert np.array_equal(sp.vstack(blocks).toarray(), expected)
+
+
+def test_mi_labels_cache_pruned():
+    """ Test that pruning the bags renews the cached labels """
+    owners = list(range(5))
+    titles = ["spam ham", "ham", "eggs spam", "spam", "eggs"]
+    bags = BagsWithVocab([[0, 1], [1], [0, 2], [2], [0, 1, 2]],
+                         {i: i for i in range(3)}, owners=owners,
+                         attributes={'title': dict(zip(owners, titles))})
+    compute_mutual_info(bags)
+    bags.prune_(min_elements=2)
+    expected = compute_mutual_info(bags.clone())
+    assert np.isclose(compute_mutual_info(bags), expected)